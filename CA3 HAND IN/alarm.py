@@ -10,7 +10,7 @@ import time
 import logging
 from datetime import datetime
 import pyttsx3
-from apicalls import get_covid, get_news, get_weather
+from apicalls import get_covid, get_news, get_weather, RING
 
 
 class Alarm:
@@ -47,7 +47,8 @@ class Alarm:
         and date, to calculate the number of seconds until the alarm is due to ring. This integer is
         then returned so the alarm can be scheduled.
     """
-    def __init__(self, message, content, news, weather, alarm_list):
+    def __init__(self, message, content, news, weather, alarm_list, *, coinciding=None,
+                 alarm_id=None):
         """
         The init function takes all the parameters of the alarm, and is responsible for
         instantiating the correct alarm with the correct priority and id.
@@ -56,19 +57,27 @@ class Alarm:
         :param news: int
         :param weather: int
         :param alarm_list: list
+        :param coinciding: int - the number of alarms in alarm_list due at the same time, if this
+                           is already known (e.g. when importing many alarms) alarm_list isn't
+                           searched for them
+        :param alarm_id: int - a unique id for the alarm, if it isn't given the length of
+                         alarm_list is used
         """
-        self.title = message + ':' + str(len(alarm_list))
+        if alarm_id is None:
+            alarm_id = len(alarm_list)
+        self.title = message + ':' + str(alarm_id)
         self.content = "Time = " + content[1] + ", Date = " + content[0]
         self.date_time = content
         self.news = news
         self.weather = weather
-        self.id = str(len(alarm_list))
-        coinciding_alarms = 1
-        for alarm in alarm_list:
-            if alarm.get_data()['date_time'] == content:
-                coinciding_alarms += 1
-        self.priority = coinciding_alarms
-        dat = 'Alarm Instance ' + str(len(alarm_list)) + ' Created'
+        self.id = str(alarm_id)
+        if coinciding is None:
+            coinciding = 0
+            for alarm in alarm_list:
+                if alarm.get_data()['date_time'] == content:
+                    coinciding += 1
+        self.priority = coinciding + 1
+        dat = 'Alarm Instance ' + str(alarm_id) + ' Created'
         logging.log(20, dat)
 
     def get_data(self):
@@ -94,17 +103,19 @@ class Alarm:
 
         # add any extra information to the message if required
         # add news information if required
+        # (the news can be empty if the daily budget of the key has been used up)
         if self.news == 1:
-            news = get_news(1, [], 0)[0]
-            msg = msg + '. ' + news['title']
+            news = get_news(1, [], 0, RING)
+            if news:
+                msg = msg + '. ' + news[0]['title']
 
-            # add even more information is required
-            if news['depth'] == 1:
-                msg = msg + '. ' + news['content']
+                # add even more information is required
+                if news[0]['depth'] == 1:
+                    msg = msg + '. ' + news[0]['content']
 
         # add weather information if required
         if self.weather == 1:
-            msg = msg + '. ' + get_weather()
+            msg = msg + '. ' + get_weather(RING)
 
         # add covid data to the message
         msg = msg + '. ' + get_covid()
@@ -3,20 +3,367 @@ The purpose of the apicalls module is to contain the functions that return the r
 from online api's when called. They are responsible for using the config file to gather the
 correct keys, URL's and settings as well as prevent the code from crashing by catching and
 logging errors while also allowing the main program to continue running.
+Classes:
+    QuotaManager
 Functions:
-    get_news(quantity, deleted_notifs, addition) -> list
-    get_weather -> str
+    get_news(quantity, deleted_notifs, addition, priority) -> list
+    get_weather(priority) -> str
     get_covid -> str
+    budget_report -> dict
+
+Misc variables:
+    RING: str
+    REFRESH: str
+    RING_TTL: int
+    REQUEST_TIMEOUT: int
+    news_quota: QuotaManager
+    weather_quota: QuotaManager
 """
 
 import json
+import time
 import logging
 import socket
+import threading
+from bisect import bisect_left, bisect_right, insort
+from datetime import date, datetime, timedelta
 import requests
 from uk_covid19 import Cov19API
 
+# priorities that can be given to a request, fetches for an alarm that is about to ring are
+# allowed to use the budget that is kept back from dashboard refreshes
+RING = 'ring'
+REFRESH = 'refresh'
+
+# the number of seconds to wait for the news or weather API before giving up on the request
+REQUEST_TIMEOUT = 5
+
+# ringing alarms are served cached data younger than this many seconds, so alarms that ring
+# together share one request
+RING_TTL = 60
+
+
+class QuotaManager:
+    """
+    A Class to represent the daily request budget of an API key, it works as a token bucket
+    which is refilled so that the remaining daily quota is spread out across the rest of the day
+
+    Attributes
+    ----------
+    name : str
+        the name of the API the budget belongs to, used when logging and reporting
+    daily_quota : int
+        the number of requests the key is allowed to make in a day
+    cache_ttl : int
+        the number of seconds cached data is served to dashboard refreshes before it is re-fetched
+    tokens : float
+        the number of requests that can currently be made straight away
+    spent : int
+        the number of requests that have been made today
+    reservations : list
+        a sorted list of timestamps of alarms that will need a fetch from this API when they ring
+    state_file : str
+        the json file the day, spend and tokens are saved to so they survive a restart, or None if
+        they are only kept in memory
+
+    Methods
+    -------
+    set_limits(daily_quota, cache_ttl):
+        Updates the daily quota and cache lifetime with the values from the config file
+    reserve(due):
+        Keeps a request back for an alarm which is due to ring at the timestamp 'due'
+    release(due):
+        Removes the reservation made for an alarm which is due to ring at the timestamp 'due'
+    acquire(priority):
+        Decides if a request can be made, and if so takes it out of the budget
+    store(data):
+        Stores the data returned by a successful request so it can be served later
+    cached(priority):
+        Returns the stored data if it can be served instead of making a request
+    fallback():
+        Returns the stored data no matter how old it is, used when there is no budget left
+    get_report():
+        Gets the current budget and spend and collates it into a dictionary to be returned
+    """
+    def __init__(self, name, daily_quota, cache_ttl, state_file=None):
+        """
+        The init function takes the name and limits of the API key and starts the day with a
+        full bucket, unless state_file holds the budget saved earlier today.
+        :param name: str
+        :param daily_quota: int
+        :param cache_ttl: int
+        :param state_file: str
+        """
+        self.name = name
+        self.daily_quota = daily_quota
+        self.cache_ttl = cache_ttl
+        self.day = date.today()
+        self.spent = 0
+        self.denied = 0
+        self.cache_hits = 0
+        self.tokens = self.get_burst()
+        self.updated = time.time()
+        self.reservations = []
+        self.data = None
+        self.fetched = 0
+        self.lock = threading.Lock()
+        self.state_file = state_file
+        self.load()
+
+    def load(self) -> None:
+        """
+        Loads the budget saved in state_file, so restarting the program during the day doesn't
+        give the key its whole daily quota again. A budget saved on an earlier day is ignored.
+        :return: None
+        """
+        if self.state_file is None:
+            return
+        try:
+            with open(self.state_file) as json_file:
+                data = json.load(json_file)
+            if data['day'] == str(self.day):
+                self.spent = data['spent']
+                self.tokens = min(data['tokens'], self.get_burst())
+                self.updated = data['updated']
+                logging.log(20, self.name + ' Quota Loaded - ' + str(self.spent) +
+                            ' requests spent today')
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError):
+            logging.log(40, self.name + ' Quota State File Invalid - Starting New Budget')
+
+    def save(self) -> None:
+        """
+        Saves the day, spend and tokens to state_file. Must be called with the lock held.
+        :return: None
+        """
+        if self.state_file is None:
+            return
+        try:
+            with open(self.state_file, 'w') as json_file:
+                json.dump({'day': str(self.day), 'spent': self.spent, 'tokens': self.tokens,
+                           'updated': self.updated}, json_file)
+        except OSError:
+            logging.log(40, self.name + ' Quota State File Could Not Be Saved')
+
+    def get_burst(self) -> float:
+        """
+        Gets the largest number of requests that can be saved up in the bucket, an hours worth
+        of the daily quota (or 1 request if the quota is very small).
+        :return: float
+        """
+        return max(self.daily_quota / 24, 1)
+
+    def set_limits(self, daily_quota: int, cache_ttl: int) -> None:
+        """
+        Updates the daily quota and cache lifetime with the values from the config file, so the
+        deployer can change them while the program is running.
+        :param daily_quota: int
+        :param cache_ttl: int
+        :return: None
+        """
+        with self.lock:
+            self.daily_quota = daily_quota
+            self.cache_ttl = cache_ttl
+            self.tokens = min(self.tokens, self.get_burst())
+
+    def refill(self) -> None:
+        """
+        Adds the tokens earned since the last refill to the bucket. The rate is the remaining
+        daily quota divided by the seconds left in the day, so the key lasts until midnight.
+        At the start of a new day the spend is reset and the bucket is filled up again.
+        Must be called with the lock held.
+        :return: None
+        """
+        now = time.time()
+        if date.today() != self.day:
+            logging.log(20, self.name + ' Quota Reset - ' + str(self.spent) + ' requests spent '
+                        + 'on ' + str(self.day))
+            self.day = date.today()
+            self.spent = 0
+            self.denied = 0
+            self.tokens = self.get_burst()
+            self.updated = now
+            return
+
+        midnight = datetime.combine(self.day + timedelta(days=1), datetime.min.time())
+        seconds_left = max((midnight - datetime.now()).total_seconds(), 1)
+        remaining = max(self.daily_quota - self.spent - self.tokens, 0)
+        self.tokens = min(self.tokens + remaining * (now - self.updated) / seconds_left,
+                          self.get_burst())
+        self.updated = now
+
+    def get_imminent(self) -> int:
+        """
+        Gets the number of reservations for alarms which are due to ring within the next hour,
+        reservations for alarms which should have already rung are removed.
+        Must be called with the lock held.
+        :return: int
+        """
+        now = time.time()
+        expired = bisect_right(self.reservations, now - 3600)
+        if expired > 0:
+            del self.reservations[:expired]
+        return bisect_left(self.reservations, now + 3600)
+
+    def reserve(self, due: float) -> None:
+        """
+        Keeps a request back for an alarm which is due to ring at the timestamp 'due', once the
+        alarm is within an hour of ringing, dashboard refreshes will not be able to use it.
+        :param due: float
+        :return: None
+        """
+        with self.lock:
+            insort(self.reservations, due)
+
+    def release(self, due: float) -> None:
+        """
+        Removes the reservation made for an alarm which is due to ring at the timestamp 'due',
+        this is done once the alarm has rung or been deleted.
+        :param due: float
+        :return: None
+        """
+        with self.lock:
+            index = bisect_left(self.reservations, due)
+            if index < len(self.reservations) and self.reservations[index] == due:
+                del self.reservations[index]
+
+    def acquire(self, priority: str) -> bool:
+        """
+        Decides if a request can be made, and if so takes it out of the budget. Requests for
+        ringing alarms can use any of the daily quota that is left when there is no data younger
+        than RING_TTL to serve them, while dashboard refreshes have to leave enough tokens in the
+        bucket for the alarms that are about to ring.
+        :param priority: str
+        :return: bool
+        """
+        with self.lock:
+            self.refill()
+            if self.spent >= self.daily_quota:
+                allowed = False
+            elif priority == RING:
+                allowed = self.tokens >= 1 or self.data is None or \
+                    time.time() - self.fetched >= RING_TTL
+            else:
+                allowed = self.tokens - self.get_imminent() >= 1
+            if not allowed:
+                self.denied += 1
+                return False
+            self.tokens = max(self.tokens - 1, 0)
+            self.spent += 1
+            self.save()
+            dat = self.name + ' Quota Spent (' + str(self.spent) + '/' + \
+                str(self.daily_quota) + ')'
+        logging.log(20, dat)
+        return True
+
+    def store(self, data) -> None:
+        """
+        Stores the data returned by a successful request so it can be served later.
+        :param data: the decoded json returned by the API
+        :return: None
+        """
+        with self.lock:
+            self.data = data
+            self.fetched = time.time()
+
+    def cached(self, priority: str):
+        """
+        Returns the stored data if it can be served instead of making a request, dashboard
+        refreshes are served anything younger than cache_ttl while ringing alarms are only
+        served data younger than RING_TTL.
+        :param priority: str
+        :return: the stored data, or None if a request should be made
+        """
+        with self.lock:
+            if self.data is None:
+                return None
+            max_age = self.cache_ttl
+            if priority == RING:
+                max_age = min(self.cache_ttl, RING_TTL)
+            if time.time() - self.fetched >= max_age:
+                return None
+            self.cache_hits += 1
+            return self.data
+
+    def fallback(self):
+        """
+        Returns the stored data no matter how old it is, this is used when there is no budget
+        left to make a request.
+        :return: the stored data, or None if nothing has been stored yet
+        """
+        with self.lock:
+            if self.data is not None:
+                self.cache_hits += 1
+            return self.data
+
+    def get_report(self) -> dict:
+        """
+        Gets the current budget and spend and collates it into a dictionary to be returned
+        :returns dict: Returns a dictionary holding the budget and spend of the API key
+        """
+        with self.lock:
+            self.refill()
+            cache_age = None
+            if self.data is not None:
+                cache_age = int(time.time() - self.fetched)
+            return {'name': self.name, 'daily_quota': self.daily_quota, 'spent': self.spent,
+                    'remaining': max(self.daily_quota - self.spent, 0),
+                    'tokens': round(self.tokens, 2), 'imminent': self.get_imminent(),
+                    'denied': self.denied, 'cache_hits': self.cache_hits,
+                    'cache_age': cache_age}
+
+
+# the budgets for the 2 API keys, their limits are updated from the config file on every call
+# and their spend is saved so it isn't reset when the program is restarted
+news_quota = QuotaManager('News', 100, 300, 'news_quota.json')
+weather_quota = QuotaManager('Weather', 1000, 300, 'weather_quota.json')
+
+
+def budgeted_get(quota: QuotaManager, url: str, priority: str):
+    """
+    budgeted get makes a request to the url if the budget of the API key allows it, otherwise
+    (or if the cached data is still fresh enough for a refresh) the cached data is returned.
+    If the request fails, or the API doesn't respond within REQUEST_TIMEOUT seconds, the cached
+    data is returned too.
+    :parameter quota: the QuotaManager of the API key being used
+    :parameter url: the full url to request data from
+    :parameter priority: either RING or REFRESH depending on what the data is needed for
+    :returns: the decoded json from the API or the cache, or None if neither is available
+    """
+    data = quota.cached(priority)
+    if data is not None:
+        return data
+
+    if not quota.acquire(priority):
+        logging.log(30, quota.name + ' Quota Budget Tight - Serving Cached Data')
+        return quota.fallback()
+
+    try:
+        response = requests.get(url, timeout=REQUEST_TIMEOUT)
+    except requests.Timeout:
+        logging.log(40, quota.name + ' API Timed Out - Serving Cached Data')
+        return quota.fallback()
+    except requests.RequestException:
+        logging.log(40, quota.name + ' API Request Failed - Serving Cached Data')
+        return quota.fallback()
+    data = response.json()
+    # only keep successful responses, so an invalid key is not served from the cache
+    if response.status_code == 200:
+        quota.store(data)
+    return data
+
+
+def budget_report() -> dict:
+    """
+    budget report returns the current budget and spend of each API key
+    :returns dict: a dictionary holding a report for each of the API keys
+    """
+    return {'news': news_quota.get_report(), 'weather': weather_quota.get_report()}
+
 
-def get_news(quantity: int, deleted_notifs: list, addition: int) -> list:
+def get_news(quantity: int, deleted_notifs: list, addition: int,
+             priority: str = REFRESH) -> list:
     """
     get news it tasked with the role of accessing the news API using the data in the config
     file and returning a list of notification dictionaries containing the latest news articles.
@@ -27,6 +374,7 @@ def get_news(quantity: int, deleted_notifs: list, addition: int) -> list:
                 deleted, so that the function does not return them again
     :parameter addition: addition is the number to add to the index value of the notifications
                 if there are already notifications stored that are not going to be deleted
+    :parameter priority: RING if the news is needed for an alarm, otherwise REFRESH
     :returns list: a list of notification dictionaries are returned to the main program
                 containing updated data
     """
@@ -40,15 +388,21 @@ def get_news(quantity: int, deleted_notifs: list, addition: int) -> list:
             country = data['data']['notif_data']['country']
             base_url = data['data']['notif_data']['base_url']
             depth = data['data']['notif_data']['depth']
+            news_quota.set_limits(data['data']['notif_data'].get('daily_quota', 100),
+                                  data['data']['notif_data'].get('cache_ttl', 300))
 
         # create a response by requesting data from the url and key specified by the config file
-        response = requests.get(base_url + 'country=' + country + '&sortBy=popularity&'
-                                + 'apiKey=' + key)
+        # (or the cache if the daily budget of the key doesn't allow a request)
+        response = budgeted_get(news_quota, base_url + 'country=' + country +
+                                '&sortBy=popularity&' + 'apiKey=' + key, priority)
+        if response is None:
+            logging.log(30, 'News Quota Exhausted - No Cached Data')
+            return []
 
         # iterate through the response and add news articles that haven't been deleted before
         counter = 0
         while len(current_notifs) < quantity:
-            article = response.json()['articles'][counter]
+            article = response['articles'][counter]
             title = article['title']
             desc = article['description']
             notif = {'title': title, 'content': desc, 'index': len(current_notifs)+addition,
@@ -74,11 +428,12 @@ def get_news(quantity: int, deleted_notifs: list, addition: int) -> list:
         return []
 
 
-def get_weather() -> str:
+def get_weather(priority: str = REFRESH) -> str:
     """
     get weather has the role of accessing the weather API using the data in the config
     file and returning a string with a pre-defined level of detail(in the config file).
     It also uses parameters such as location from the config file.
+    :parameter priority: RING if the weather is needed for an alarm, otherwise REFRESH
     :returns str: Returns a string with updated weather data incorporated in written
                     english which will be able to be spoken efficiently by pyttsx3 or
                     displayed on the page.
@@ -91,13 +446,18 @@ def get_weather() -> str:
             city = data['data']['weather_data']['city']
             base_url = data['data']['weather_data']['base_url']
             depth = data['data']['weather_data']['depth']
+            weather_quota.set_limits(data['data']['weather_data'].get('daily_quota', 1000),
+                                     data['data']['weather_data'].get('cache_ttl', 300))
 
         # create a response by requesting data from the url and key specified by
-        # the config file
-        response = requests.get(base_url + city + '&units=metric&appid=' + key)
+        # the config file (or the cache if the daily budget of the key doesn't allow a request)
+        data = budgeted_get(weather_quota, base_url + city + '&units=metric&appid=' + key,
+                            priority)
+        if data is None:
+            logging.log(30, 'Weather Quota Exhausted - No Cached Data')
+            return ''
 
         # extract data from the api and create a string with relevant information.
-        data = response.json()
         msg = 'The weather is ' + data['weather'][0]['description'] + ' and it is ' + \
               str(data['main']['temp']) \
               + ' degrees celsius which feels like ' + str(data['main']['feels_like']) \
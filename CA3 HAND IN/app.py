@@ -8,15 +8,30 @@ Function:
     display_page() -> render_template
     set_alarm(request) -> redirect
     ring_alarm(Alarm)
-    delete_alarm(alarm, fin_ringing, scheduled) -> redirect
+    delete_alarm(alarm_id, fin_ringing, scheduled) -> redirect
+    admit_refresh -> Optional[list]
     refresh_notifs -> list
+    show_budget -> dict
+    import_page -> dict
+    export_page -> Response
+    import_alarms(stream) -> dict
+    cancel_alarms(alarms)
 
 
 Misc variables:
+    MAX_REFRESHES: int
+    MAX_QUEUED: int
+    QUEUE_TIMEOUT: int
+    RETRY_AFTER: int
     current_notifs: list
     deleted_notifs: list
     alarm_list: list
+    alarm_dict: dict
+    alarm_ids: Count Object
     sched_dict: dict
+    refresh_slots: BoundedSemaphore Object
+    queue_lock: Lock Object
+    queued: int
     scheduler: Sched Object
     app: Flask Application
     s: Sched Object
@@ -27,9 +42,13 @@ import sched
 import threading
 import logging
 import json
-from flask import Flask, request, render_template, redirect
-from apicalls import get_covid, get_news, get_weather
+import heapq
+import itertools
+from typing import Optional
+from flask import Flask, Response, request, render_template, redirect
+from apicalls import get_covid, get_news, get_weather, budget_report, news_quota, weather_quota
 from alarm import Alarm
+from bulk import read_alarms, write_binary, write_ndjson
 
 # This section is used to set up the format of the logging file as
 # well as the severity of 'urllib3' and 'comtypes'
@@ -39,12 +58,26 @@ logging.basicConfig(filename='sys.log', level=0, format='(%(asctime)s):%(name)s:
 logging.getLogger('urllib3').setLevel(40)
 logging.getLogger('comtypes').setLevel(40)
 
+# The section below limits how much upstream I/O the page can do at once. Only MAX_REFRESHES
+# requests refresh the notifications at the same time, the rest are shown the last notifications
+# that were refreshed. If there are none yet, up to MAX_QUEUED requests wait QUEUE_TIMEOUT seconds
+# for a refresh and any more are told to try again after RETRY_AFTER seconds.
+MAX_REFRESHES = 2
+MAX_QUEUED = 16
+QUEUE_TIMEOUT = 10
+RETRY_AFTER = 5
+
 # The section below is used to initialise many of the global
 # variables and to start the flask application
 current_notifs = []
 deleted_notifs = []
 alarm_list = []
+alarm_dict = {}
+alarm_ids = itertools.count()
 sched_dict = {}
+refresh_slots = threading.BoundedSemaphore(MAX_REFRESHES)
+queue_lock = threading.Lock()
+queued = 0
 
 # starting the scheduler
 scheduler = sched.scheduler(time.time, time.sleep)
@@ -69,14 +102,15 @@ def display_page() -> render_template:
     Display page manages all requests pointing to the /index page for the flask application.
     The main role is to check if alarms need to be created or deleted, or if notifications
     need deleting and to refresh notifications in order to pass up to date info into the template.
-    It returns a render template function which is responsible for displaying the page
+    It returns a render template function which is responsible for displaying the page.
+    Creating and deleting alarms is done before any notifications are refreshed, so these
+    requests are never held up by the API's when the server is busy.
 
     :returns render_template: Renders a web pade using the method from flask
     :returns redirect: Redirects the user to a defined web page using the method from flask
+    :returns tuple: A 503 response telling the user to retry later if the server is overloaded
     """
-    # update the list of notifications for up to date information
-    current_notifs = []
-    current_notifs += refresh_notifs()
+    global current_notifs
 
     # check if the request contains alarm data
     if request.args.get('alarm') is not None:
@@ -92,13 +126,8 @@ def display_page() -> render_template:
     if request.args.get('alarm_item') is not None:
         # alarm has to be deleted, calls the delete_alarm function and passes in the alarm item
         # as well as 'False' which specifies that the alarm has not gone off yet
-        print(request.args.get('alarm_item').split(':')[1])
         logging.log(20, 'Page requires an alarm to be deleted')
-        id = request.args.get('alarm_item').split(':')[1]
-        for alarm in alarm_list:
-            if alarm.get_data()['id'] == id:
-                print(alarm)
-                delete_alarm(str(alarm), False, True)
+        delete_alarm(request.args.get('alarm_item').rsplit(':', 1)[1], False, True)
 
         # redirects the user back to the main page at the end to continue using the app
         return redirect('/index')
@@ -108,19 +137,28 @@ def display_page() -> render_template:
         # array so its isn't used again. As the user deleted it, it is assumed
         # they dont want to see it next time the page is loaded.
         logging.log(20, 'Page requires an notification to be deleted')
+        # the notification is looked for in the notifications that were last shown to the user,
+        # and removed from them so it isn't shown again while the server is busy
         title = request.args.get('notif')
         for element in current_notifs:
             if element['title'] == title:
-                index = element['index']
-        deleted_notifs.append(current_notifs[index])
-        del current_notifs[index]
+                deleted_notifs.append(element)
+        current_notifs = [element for element in current_notifs if element['title'] != title]
 
         # redirects the user back to the main page at the end to continue using the app
         return redirect('/index')
+
+    # update the list of notifications for up to date information, if the server is too busy
+    # to do this the user is asked to try again later
+    notifs = admit_refresh()
+    if notifs is None:
+        logging.log(30, 'Server Overloaded - Page Request Rejected')
+        return 'Server Busy, Please Try Again', 503, {'Retry-After': str(RETRY_AFTER)}
+
     # if no actions are to be taken, then the page(template) can be rendered, sending in the
     # list of alarms, list of notification and the image that will be used by the template.
     return render_template('template.html', alarms=alarm_list,
-                           notifications=current_notifs, image='covid.svg')
+                           notifications=notifs, image='covid.svg')
 
 
 def set_alarm(req: request) -> redirect:
@@ -152,8 +190,10 @@ def set_alarm(req: request) -> redirect:
     # the data above is then used to create an alarm object using the Alarm class
     # defined separately, this alarm is then appended to alarm_list - a list containing all
     # the alarm instances.
-    alarm_object = Alarm(message, alarm, news, weather, alarm_list)
+    # the id comes from alarm_ids so it is never the same as an alarm that has been deleted
+    alarm_object = Alarm(message, alarm, news, weather, alarm_list, alarm_id=next(alarm_ids))
     alarm_list.append(alarm_object)
+    alarm_dict[alarm_object.id] = alarm_object
 
     # the counter for the total number of alarms is incremented
 
@@ -161,7 +201,7 @@ def set_alarm(req: request) -> redirect:
     if alarm_object.get_seconds() < 0:
         # too late to set the alarm, delete it amd specify 'True' as the
         # alarm schedule has not yet been created
-        delete_alarm(str(alarm_object), True, False)
+        delete_alarm(alarm_object.id, True, False)
         # the user can be redirected to the main page from here as the
         # schedule should not be created
         return redirect('/index')
@@ -173,6 +213,13 @@ def set_alarm(req: request) -> redirect:
                        ring_alarm, [alarm_object])
     sched_dict[alarm_data['id']] = my_sched
 
+    # keep requests back from the daily budget of the API keys so the alarm can fetch fresh
+    # news and weather when it rings
+    if alarm_data['news'] == 1:
+        news_quota.reserve(my_sched.time)
+    if alarm_data['weather'] == 1:
+        weather_quota.reserve(my_sched.time)
+
     # run the schedule for the alarm in a separate thread to ensure it goes
     # off correctly and is uninterrupted and also allows the web page to
     # continue running to other alarms can be created or deleted...
@@ -193,50 +240,92 @@ def ring_alarm(alarm: Alarm) -> None:
     """
     alarm.ring()
     # true is passed in from here as the alarm has finished ringing
-    delete_alarm(str(alarm), True, True)
+    delete_alarm(alarm.id, True, True)
     return None
 
 
-def delete_alarm(alarm: str, fin_ringing: bool, scheduled: bool) -> redirect:
+def delete_alarm(alarm_id: str, fin_ringing: bool, scheduled: bool) -> redirect:
     """
     The delete_alarm function makes sure all aspects of the alarm are deleted
-    It removes the alarm from alarm_list, and the schedule from the sched_dict
+    It removes the alarm from alarm_list and alarm_dict, and the schedule from the sched_dict
     As well as cancelling the schedule if necessary and deleting the alarm instance.
     The user is then redirected to the /index page to continue using the application
-    :parameter alarm: this parameter is the string representation of an alarm object
+    :parameter alarm_id: this parameter is the id of an alarm object
     :parameter fin_ringing: Boolean used to determine if the alarm in question has finished
                ringing or not
     :parameter scheduled: Boolean used to determine if a shced entry has been made for this alarm
     :returns redirect: Redirects the user to a defined web page using the method from flask
     """
+    # Looks for the correct alarm in the alarm_dict
+    instance = alarm_dict.pop(alarm_id, None)
+    if instance is not None:
+        # if it is found, its data is found and it is removed from the list
+        alarm_data = instance.get_data()
+
+        # if it has not finished ringing, the schedule needs to be cancelled
+        if not fin_ringing:
+            logging.log(20, 'Sched for ' + alarm_data['id'] + ' has been deleted')
+            s.cancel(sched_dict[alarm_data['id']])
+
+        # if it was scheduled at some point, the event needs to be removed from the sched_dict
+        # and any requests kept back for it are given back to the budget
+        if scheduled:
+            event = sched_dict.pop(alarm_data['id'])
+            if alarm_data['news'] == 1:
+                news_quota.release(event.time)
+            if alarm_data['weather'] == 1:
+                weather_quota.release(event.time)
+        alarm_list.remove(instance)
 
-    print(sched_dict)
-    print(alarm_list)
-    # Looks for the correct alarm in the alarm_list
-    for instance in alarm_list:
-
-        if str(instance) == alarm:
-            # if it is found, its data is found and it is removed from the list
-            alarm_data = instance.get_data()
-
-            # if it has not finished ringing, the schedule needs to be cancelled
-            if not fin_ringing:
-                logging.log(20, 'Sched for ' + alarm_data['id'] + ' has been deleted')
-                s.cancel(sched_dict[alarm_data['id']])
-
-            # if it was scheduled at some point, the event needs to be removed from the sched_dict
-            if scheduled:
-                sched_dict.pop(alarm_data['id'])
-            alarm_list.remove(instance)
-
-            # no more identical alarms can be found,so the for loop can be exited using continue
-            continue
-    print(sched_dict)
-    print(alarm_list)
     # redirect the user back to the main page to allow the to continue using the application.
     return redirect('/index')
 
 
+def admit_refresh() -> Optional[list]:
+    """
+    admit_refresh decides if the current request is allowed to refresh the notifications.
+    If one of the MAX_REFRESHES slots is free the notifications are refreshed and stored in
+    current_notifs, otherwise the notifications that were last refreshed are returned straight away.
+    If no notifications have been refreshed yet, the request waits for a slot in a queue of at
+    most MAX_QUEUED requests, and once it has a slot it uses the notifications refreshed by the
+    request it was waiting for if there are any.
+    :returns list: Returns a list of notifications to be displayed on the page
+    :returns None: Returns None if the queue is full or no slot was free in time
+    """
+    global current_notifs, queued
+
+    # the slot is taken without waiting if possible, if not the last notifications are served
+    admitted = refresh_slots.acquire(blocking=False)
+    if not admitted:
+        if current_notifs:
+            logging.log(30, 'Server Busy - Serving Last Notifications')
+            return current_notifs
+
+        # there is nothing to serve yet, so join the queue if it isn't full
+        with queue_lock:
+            if queued >= MAX_QUEUED:
+                return None
+            queued += 1
+        try:
+            admitted = refresh_slots.acquire(timeout=QUEUE_TIMEOUT)
+        finally:
+            with queue_lock:
+                queued -= 1
+        if not admitted:
+            return None
+
+        # the request that held the slot may have just refreshed the notifications
+        if current_notifs:
+            refresh_slots.release()
+            return current_notifs
+
+    try:
+        current_notifs = refresh_notifs()
+    finally:
+        refresh_slots.release()
+    return current_notifs
+
+
 def refresh_notifs() -> list:
     """
     Uses the apicalls module to return a list of the latest notifications, and if required the
@@ -271,6 +360,134 @@ def refresh_notifs() -> list:
     return new_notifs
 
 
+@app.route('/budget')
+def show_budget() -> dict:
+    """
+    Reports the current budget and spend of the news and weather API keys, flask returns the
+    dictionary to the browser as json.
+    :returns dict: Returns a dictionary holding a report for each of the API keys
+    """
+    logging.log(20, 'Quota Budget Requested')
+    return budget_report()
+
+
+@app.route('/import', methods=['POST'])
+def import_page():
+    """
+    Imports the NDJSON or binary alarm file sent as the body of the request, see the bulk module
+    for the formats. If any alarm in the file is invalid, none of the alarms are imported.
+    :returns dict: Returns the number of alarms imported and skipped, as json
+    :returns tuple: A 400 response saying which alarm was invalid
+    """
+    logging.log(20, 'Page requires alarms to be imported')
+    try:
+        return import_alarms(request.stream)
+    except ValueError as error:
+        logging.log(40, 'Alarm Import Failed - ' + str(error))
+        return {'error': str(error)}, 400
+
+
+@app.route('/export')
+def export_page() -> Response:
+    """
+    Streams all the alarms that are set as NDJSON, or in the binary format if the request
+    contains format=binary.
+    :returns Response: A streamed response containing the alarms
+    """
+    logging.log(20, 'Page requires alarms to be exported')
+    # a copy of the list is used so alarms ringing during the export don't affect it
+    alarms = []
+    for alarm in list(alarm_list):
+        alarm_data = alarm.get_data()
+        alarms.append((alarm_data['title'].rsplit(':', 1)[0], alarm_data['date_time'],
+                       alarm_data['news'], alarm_data['weather']))
+    if request.args.get('format') == 'binary':
+        return Response(write_binary(alarms), mimetype='application/octet-stream')
+    return Response(write_ndjson(alarms), mimetype='application/x-ndjson')
+
+
+def import_alarms(stream) -> dict:
+    """
+    import_alarms reads the alarms from the stream in chunks, creating and scheduling each chunk
+    once it has been checked so only one chunk of the file is held in memory at a time. If a later
+    chunk is invalid, the alarms from the earlier chunks are cancelled again so a failed import
+    doesn't leave half of the alarms set. Alarms that are due in the past are skipped, as they
+    are by set_alarm. Only one thread is started to run the schedule for the whole import.
+    :parameter stream: a binary file like object containing NDJSON or binary alarms
+    :returns dict: Returns the number of alarms imported and skipped
+    """
+    # count the alarms already due at each time, so each new alarm doesn't search alarm_list
+    coinciding = {}
+    for alarm in alarm_list:
+        date_time = tuple(alarm.get_data()['date_time'])
+        coinciding[date_time] = coinciding.get(date_time, 0) + 1
+
+    imported = []
+    skipped = 0
+    now = time.time()
+    try:
+        for chunk in read_alarms(stream):
+            for message, date_time, news, weather, minutes in chunk:
+                due = minutes * 60
+                if due <= now:
+                    skipped += 1
+                    continue
+                key = tuple(date_time)
+                alarm_object = Alarm(message, date_time, news, weather, alarm_list,
+                                     coinciding=coinciding.get(key, 0), alarm_id=next(alarm_ids))
+                coinciding[key] = coinciding.get(key, 0) + 1
+                alarm_list.append(alarm_object)
+                alarm_dict[alarm_object.id] = alarm_object
+
+                # the event is scheduled at the exact time rather than using get_seconds()
+                my_sched = s.enterabs(due, alarm_object.priority, ring_alarm, [alarm_object])
+                sched_dict[alarm_object.id] = my_sched
+                if news == 1:
+                    news_quota.reserve(due)
+                if weather == 1:
+                    weather_quota.reserve(due)
+                imported.append(alarm_object)
+    except ValueError:
+        cancel_alarms(imported)
+        raise
+
+    if imported:
+        threading.Thread(target=s.run).start()
+    logging.log(20, str(len(imported)) + ' Alarms Imported, ' + str(skipped) + ' Skipped')
+    return {'imported': len(imported), 'skipped': skipped}
+
+
+def cancel_alarms(alarms: list) -> None:
+    """
+    cancel_alarms deletes many alarms that haven't rung yet at once, it is used to undo an import
+    that failed part of the way through. s.cancel() searches the whole queue for each event, which
+    takes minutes for a large import, so the scheduler's queue is filtered once instead (in the
+    same way as s.cancel() changes it) and alarm_list is rebuilt once.
+    :parameter alarms: a list of the alarm instances to delete
+    :returns None:
+    """
+    events = []
+    for instance in alarms:
+        alarm_dict.pop(instance.id, None)
+        event = sched_dict.pop(instance.id, None)
+        # alarms that have already rung and deleted themselves have no event left
+        if event is None:
+            continue
+        events.append(event)
+        if instance.news == 1:
+            news_quota.release(event.time)
+        if instance.weather == 1:
+            weather_quota.release(event.time)
+
+    cancelled = set(id(event) for event in events)
+    with s._lock:
+        s._queue[:] = [event for event in s._queue if id(event) not in cancelled]
+        heapq.heapify(s._queue)
+    deleted = set(id(instance) for instance in alarms)
+    alarm_list[:] = [instance for instance in alarm_list if id(instance) not in deleted]
+    logging.log(20, str(len(alarms)) + ' Alarms Cancelled')
+
+
 if __name__ == '__main__':
     app.run()
 
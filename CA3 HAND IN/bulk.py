@@ -0,0 +1,334 @@
+"""
+The purpose of the bulk module is to read and write many alarms at once so they can be moved in
+and out of the application without using the form one alarm at a time. Two formats are supported,
+NDJSON (one json alarm per line) and a compact binary format. Alarms are read lazily in chunks so
+large files never need to be held in memory as text, and invalid alarms raise a ValueError that
+says which alarm was wrong.
+
+The binary format starts with the 4 bytes MAGIC, followed by any number of blocks. Each block holds
+up to CHUNK_SIZE alarms and MAX_BLOCK_BYTES of messages stored as columns (all numbers are little
+endian):
+    uint32 count, uint32 length of the message bytes
+    count x uint32 minutes since the epoch when the alarm is due (local time)
+    count x uint8 flags (1 = news, 2 = weather)
+    count x uint32 offset of the end of each message in the message bytes
+    the utf-8 message bytes
+
+The module can also be run from the command line to import or export alarms from a running app:
+    python bulk.py import alarms.ndjson
+    python bulk.py export alarms.bin --format binary
+
+Functions:
+    to_minutes(date_time) -> int
+    from_minutes(minutes) -> list
+    parse_record(record, number) -> tuple
+    read_alarms(stream) -> generator
+    read_ndjson(stream) -> generator
+    read_lines(stream, start) -> generator
+    read_exact(stream, size) -> bytes
+    read_binary(stream) -> generator
+    write_ndjson(alarms) -> generator
+    pack_block(minutes, flags, messages) -> bytes
+    write_binary(alarms) -> generator
+    main(args)
+
+Misc variables:
+    MAGIC: bytes
+    CHUNK_SIZE: int
+    MAX_BLOCK_BYTES: int
+    NEWS: int
+    WEATHER: int
+    BLOCK_HEADER: Struct Object
+"""
+
+import sys
+import json
+import struct
+import argparse
+from datetime import datetime
+import requests
+
+MAGIC = b'CAL1'
+CHUNK_SIZE = 4096
+MAX_BLOCK_BYTES = 4 * 1024 * 1024
+NEWS = 1
+WEATHER = 2
+BLOCK_HEADER = struct.Struct('<II')
+
+
+def to_minutes(date_time: list) -> int:
+    """
+    to_minutes turns the date and time of an alarm into the number of minutes since the epoch.
+    :parameter date_time: a list containing the date and time of the alarm,
+                e.g. ['2020-12-01', '12:59']
+    :returns int: the number of minutes since the epoch when the alarm is due
+    """
+    due = datetime.strptime(date_time[0] + 'T' + date_time[1], '%Y-%m-%dT%H:%M')
+    return int(due.timestamp()) // 60
+
+
+def from_minutes(minutes: int) -> list:
+    """
+    from_minutes turns a number of minutes since the epoch back into the date and time
+    of an alarm.
+    :parameter minutes: the number of minutes since the epoch when the alarm is due
+    :returns list: a list containing the date and time of the alarm
+    """
+    due = datetime.fromtimestamp(minutes * 60)
+    return [due.strftime('%Y-%m-%d'), due.strftime('%H:%M')]
+
+
+def parse_record(record: dict, number: int) -> tuple:
+    """
+    parse_record checks a decoded NDJSON alarm and turns it into an alarm tuple. The date and
+    time are rewritten in the same format as the form uses, e.g. '2030-1-1T7:30' becomes
+    ['2030-01-01', '07:30'].
+    :parameter record: a dictionary with the keys 'alarm' (e.g. '2020-12-01T12:59'), 'message',
+                and optionally 'news' and 'weather' (1 or 0)
+    :parameter number: the line number of the alarm, used in the error message
+    :returns tuple: (message, date_time, news, weather, minutes)
+    """
+    try:
+        message = record['message']
+        date_time = record['alarm'].split('T')
+        news = record.get('news', 0)
+        weather = record.get('weather', 0)
+        if not isinstance(message, str) or message == '':
+            raise ValueError('message must be a non empty string')
+        if len(message.encode('utf-8')) > MAX_BLOCK_BYTES:
+            raise ValueError('message is too long')
+        # true, false and 1.0 are not accepted, so they can't be stored instead of 1 or 0
+        if type(news) is not int or type(weather) is not int or news not in (0, 1) \
+                or weather not in (0, 1):
+            raise ValueError('news and weather must be 1 or 0')
+        if len(date_time) != 2:
+            raise ValueError('alarm must be in the format YYYY-MM-DDTHH:MM')
+        minutes = to_minutes(date_time)
+        date_time = from_minutes(minutes)
+    except (KeyError, TypeError, AttributeError, ValueError) as error:
+        raise ValueError('Alarm ' + str(number) + ' is invalid: ' + str(error)) from error
+    return message, date_time, news, weather, minutes
+
+
+def read_ndjson(stream) -> list:
+    """
+    read_ndjson reads alarms from a stream of NDJSON lines, yielding lists of at most
+    CHUNK_SIZE alarm tuples. Blank lines are ignored.
+    :parameter stream: an iterable of lines, such as a binary file like object
+    :returns generator: lists of (message, date_time, news, weather, minutes) tuples
+    """
+    chunk = []
+    for number, line in enumerate(stream, 1):
+        if line.strip() == b'':
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            raise ValueError('Alarm ' + str(number) + ' is not valid json') from error
+        chunk.append(parse_record(record, number))
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def read_lines(stream, start: bytes = b'') -> bytes:
+    """
+    read_lines yields the lines of the stream, reading it in large blocks as reading a request
+    stream line by line is very slow.
+    :parameter stream: a binary file like object
+    :parameter start: bytes that have already been read from the front of the stream
+    :returns generator: the lines of the stream
+    """
+    rest = start
+    while True:
+        block = stream.read(65536)
+        if not block:
+            break
+        lines = (rest + block).split(b'\n')
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
+
+def read_exact(stream, size: int) -> bytes:
+    """
+    read_exact reads exactly 'size' bytes from the stream, as streams can return less than asked.
+    :parameter stream: a binary file like object
+    :parameter size: the number of bytes to read
+    :returns bytes: the bytes read, which are shorter than 'size' only if the stream ended
+    """
+    parts = []
+    remaining = size
+    while remaining > 0:
+        part = stream.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return b''.join(parts)
+
+
+def read_binary(stream) -> list:
+    """
+    read_binary reads alarms from a stream in the binary format (after MAGIC has been read),
+    yielding a list of alarm tuples for each block. Blocks claiming more than CHUNK_SIZE alarms
+    or MAX_BLOCK_BYTES of messages are rejected before they are read, so a block can't make the
+    whole file be read into memory.
+    :parameter stream: a binary file like object
+    :returns generator: lists of (message, date_time, news, weather, minutes) tuples
+    """
+    number = 0
+    while True:
+        header = read_exact(stream, BLOCK_HEADER.size)
+        if header == b'':
+            return
+        if len(header) != BLOCK_HEADER.size:
+            raise ValueError('Block after alarm ' + str(number) + ' is truncated')
+        count, length = BLOCK_HEADER.unpack(header)
+        if count > CHUNK_SIZE or length > MAX_BLOCK_BYTES:
+            raise ValueError('Block after alarm ' + str(number) + ' is too large')
+        body = read_exact(stream, count * 9 + length)
+        if len(body) != count * 9 + length:
+            raise ValueError('Block after alarm ' + str(number) + ' is truncated')
+
+        # split the block back into its columns
+        minutes = struct.unpack_from('<%dI' % count, body, 0)
+        flags = body[count * 4:count * 5]
+        offsets = struct.unpack_from('<%dI' % count, body, count * 5)
+        messages = body[count * 9:]
+
+        chunk = []
+        start = 0
+        for i in range(count):
+            number += 1
+            end = offsets[i]
+            if flags[i] > NEWS | WEATHER or end < start or end > length:
+                raise ValueError('Alarm ' + str(number) + ' is invalid')
+            try:
+                message = messages[start:end].decode('utf-8')
+            except UnicodeDecodeError as error:
+                raise ValueError('Alarm ' + str(number) + ' is invalid') from error
+            if message == '':
+                raise ValueError('Alarm ' + str(number) + ' is invalid')
+            try:
+                date_time = from_minutes(minutes[i])
+            except (ValueError, OverflowError, OSError) as error:
+                raise ValueError('Alarm ' + str(number) + ' is invalid') from error
+            chunk.append((message, date_time, int((flags[i] & NEWS) > 0),
+                          int((flags[i] & WEATHER) > 0), minutes[i]))
+            start = end
+        yield chunk
+
+
+def read_alarms(stream) -> list:
+    """
+    read_alarms works out if the stream is in the binary format or NDJSON from its first bytes
+    and reads it with the correct function.
+    :parameter stream: a binary file like object
+    :returns generator: lists of (message, date_time, news, weather, minutes) tuples
+    """
+    start = read_exact(stream, len(MAGIC))
+    if start == MAGIC:
+        return read_binary(stream)
+    # the bytes that were read to check the format are put back in front of the first line
+    return read_ndjson(read_lines(stream, start))
+
+
+def write_ndjson(alarms) -> bytes:
+    """
+    write_ndjson turns alarms into NDJSON, yielding the bytes of CHUNK_SIZE alarms at a time.
+    :parameter alarms: an iterable of (message, date_time, news, weather) tuples
+    :returns generator: bytes to be written or streamed
+    """
+    lines = []
+    for message, date_time, news, weather in alarms:
+        lines.append(json.dumps({'alarm': date_time[0] + 'T' + date_time[1], 'message': message,
+                                 'news': news, 'weather': weather}) + '\n')
+        if len(lines) == CHUNK_SIZE:
+            yield ''.join(lines).encode('utf-8')
+            lines = []
+    if lines:
+        yield ''.join(lines).encode('utf-8')
+
+
+def pack_block(minutes: list, flags: list, messages: list) -> bytes:
+    """
+    pack_block packs the columns of up to CHUNK_SIZE alarms into a block of the binary format.
+    :parameter minutes: a list of the minutes since the epoch when each alarm is due
+    :parameter flags: a list of the flags of each alarm
+    :parameter messages: a list of the utf-8 encoded messages of each alarm
+    :returns bytes: the packed block
+    """
+    offsets = []
+    end = 0
+    for message in messages:
+        end += len(message)
+        offsets.append(end)
+    count = len(minutes)
+    return BLOCK_HEADER.pack(count, end) + struct.pack('<%dI' % count, *minutes) + \
+        bytes(flags) + struct.pack('<%dI' % count, *offsets) + b''.join(messages)
+
+
+def write_binary(alarms) -> bytes:
+    """
+    write_binary turns alarms into the binary format, yielding MAGIC and then a block for every
+    CHUNK_SIZE alarms, or fewer if their messages would be longer than MAX_BLOCK_BYTES.
+    :parameter alarms: an iterable of (message, date_time, news, weather) tuples
+    :returns generator: bytes to be written or streamed
+    """
+    yield MAGIC
+    minutes, flags, messages = [], [], []
+    length = 0
+    for message, date_time, news, weather in alarms:
+        message = message.encode('utf-8')
+        if minutes and length + len(message) > MAX_BLOCK_BYTES:
+            yield pack_block(minutes, flags, messages)
+            minutes, flags, messages = [], [], []
+            length = 0
+        minutes.append(to_minutes(date_time))
+        flags.append(NEWS * news | WEATHER * weather)
+        messages.append(message)
+        length += len(message)
+        if len(minutes) == CHUNK_SIZE:
+            yield pack_block(minutes, flags, messages)
+            minutes, flags, messages = [], [], []
+            length = 0
+    if minutes:
+        yield pack_block(minutes, flags, messages)
+
+
+def main(args: list) -> None:
+    """
+    main runs the command line interface, which streams a file to the /import page of a running
+    app or saves the alarms from its /export page to a file.
+    :parameter args: the command line arguments
+    :returns None:
+    """
+    parser = argparse.ArgumentParser(description='Import or export alarms in bulk')
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('file', help='the NDJSON or binary alarm file')
+    parser.add_argument('--format', choices=['ndjson', 'binary'], default='ndjson',
+                        help='the format to export in (imports detect the format)')
+    parser.add_argument('--url', default='http://127.0.0.1:5000',
+                        help='the address of the running app')
+    args = parser.parse_args(args)
+
+    if args.action == 'import':
+        # the file object is streamed by requests rather than read into memory
+        with open(args.file, 'rb') as alarm_file:
+            response = requests.post(args.url + '/import', data=alarm_file)
+        print(response.status_code, response.text)
+    else:
+        response = requests.get(args.url + '/export', params={'format': args.format},
+                                stream=True)
+        response.raise_for_status()
+        with open(args.file, 'wb') as alarm_file:
+            for part in response.iter_content(65536):
+                alarm_file.write(part)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
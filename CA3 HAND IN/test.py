@@ -1,10 +1,43 @@
 import unittest
-import app, apicalls, alarm, json
+import io
+import os
+import time
+import tempfile
+import threading
+from unittest import mock
+import app, apicalls, alarm, bulk, json
 from datetime import datetime, timedelta
 
 
+def slow_refresh():
+    # stands in for refresh_notifs() when the API's take half a second to respond
+    time.sleep(0.5)
+    return [{'title': 'Test', 'content': 'This is a notification', 'index': 0, 'depth': 0}]
+
+
+def burst(urls):
+    # requests every url at the same time, returning the status code and seconds taken for each
+    results = [None] * len(urls)
+
+    def get(i):
+        start = time.time()
+        response = app.app.test_client().get(urls[i])
+        results[i] = (response.status_code, time.time() - start, response.headers)
+
+    threads = [threading.Thread(target=get, args=[i]) for i in range(len(urls))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
 class ProjectTest(unittest.TestCase):
 
+    def tearDown(self):
+        # the notifications shown by the app are reset so tests don't depend on their order
+        app.current_notifs = []
+
     # Test API Calls
     def test_get_news(self):
         with open('config.json') as json_file:
@@ -79,6 +112,200 @@ class ProjectTest(unittest.TestCase):
         self.assertEqual(result['id'], expected_result['id'])
         self.assertEqual(result['priority'], expected_result['priority'])
 
+    # Test API Quota Budget
+    def test_quota(self):
+        # a quota of 48 allows a burst of 2 requests (an hours worth) before the bucket is empty
+        quota = apicalls.QuotaManager('Test', 48, 300)
+        self.assertTrue(quota.acquire(apicalls.REFRESH))
+        self.assertTrue(quota.acquire(apicalls.REFRESH))
+        self.assertFalse(quota.acquire(apicalls.REFRESH))
+        # alarms that are ringing can still use the rest of the daily quota
+        self.assertTrue(quota.acquire(apicalls.RING))
+        result = quota.get_report()
+        self.assertEqual(result['spent'], 3)
+        self.assertEqual(result['remaining'], 45)
+        self.assertEqual(result['denied'], 1)
+
+    def test_quota_1(self):
+        # test that refreshes leave requests in the bucket for alarms that are about to ring
+        quota = apicalls.QuotaManager('Test', 48, 300)
+        due = (datetime.now() + timedelta(minutes=2)).timestamp()
+        quota.reserve(due)
+        self.assertTrue(quota.acquire(apicalls.REFRESH))
+        self.assertFalse(quota.acquire(apicalls.REFRESH))
+        quota.release(due)
+        self.assertTrue(quota.acquire(apicalls.REFRESH))
+
+    def test_quota_2(self):
+        # test that cached data is served to refreshes but not to ringing alarms
+        quota = apicalls.QuotaManager('Test', 48, 300)
+        self.assertIsNone(quota.cached(apicalls.REFRESH))
+        quota.store({'articles': []})
+        self.assertEqual(quota.cached(apicalls.REFRESH), {'articles': []})
+        self.assertEqual(quota.cached(apicalls.RING), {'articles': []})
+        quota.fetched -= apicalls.RING_TTL
+        self.assertIsNone(quota.cached(apicalls.RING))
+        self.assertEqual(quota.get_report()['cache_hits'], 2)
+
+    def test_quota_3(self):
+        # test that alarms ringing together can't use up the daily quota while there is
+        # fresh data to serve them
+        quota = apicalls.QuotaManager('Test', 100, 300)
+        quota.store({'articles': []})
+        allowed = [quota.acquire(apicalls.RING) for i in range(200)]
+        self.assertEqual(allowed.count(True), 4)
+
+    # Test Admission Control Under Load
+    @mock.patch('app.refresh_notifs', side_effect=slow_refresh)
+    def test_burst(self, refresh):
+        # 50 users open the page at once, only MAX_REFRESHES of them wait for the API's and the
+        # rest are shown the last notifications, so no request takes much longer than 1 refresh
+        app.current_notifs = slow_refresh()
+        results = burst(['/index'] * 50 + ['/index?alarm_item=Test:99'])
+        self.assertLessEqual(refresh.call_count, app.MAX_REFRESHES)
+        self.assertEqual([result[0] for result in results[:50]], [200] * 50)
+        self.assertLess(max(result[1] for result in results), 1.5)
+
+        # deleting an alarm doesn't wait for the API's at all
+        self.assertEqual(results[50][0], 302)
+        self.assertLess(results[50][1], 0.5)
+
+    @mock.patch('app.refresh_notifs', side_effect=slow_refresh)
+    @mock.patch('app.MAX_QUEUED', 2)
+    def test_burst_1(self, refresh):
+        # with no notifications to fall back on, requests beyond the queue are told to retry
+        app.current_notifs = []
+        results = burst(['/index'] * 10)
+        rejected = [result for result in results if result[0] == 503]
+        self.assertEqual(len(rejected), 10 - app.MAX_REFRESHES - 2)
+        self.assertEqual(rejected[0][2]['Retry-After'], str(app.RETRY_AFTER))
+        self.assertLess(max(result[1] for result in rejected), 0.5)
+        # the queued requests use the notifications refreshed while they waited
+        self.assertEqual(refresh.call_count, app.MAX_REFRESHES)
+
+    def test_burst_2(self):
+        # test that a deleted notification isn't shown to requests served the last notifications
+        app.current_notifs = slow_refresh()
+        app.app.test_client().get('/index?notif=Test')
+        self.assertEqual(app.current_notifs, [])
+
+    @mock.patch('apicalls.requests.get', side_effect=apicalls.requests.Timeout)
+    def test_timeout(self, get):
+        # test that an API which doesn't respond gives up and serves the cached data
+        quota = apicalls.QuotaManager('Test', 48, 0)
+        quota.store({'articles': []})
+        self.assertEqual(apicalls.budgeted_get(quota, 'http://test', apicalls.REFRESH),
+                         {'articles': []})
+        self.assertEqual(get.call_args[1]['timeout'], apicalls.REQUEST_TIMEOUT)
+
+    @mock.patch('apicalls.requests.get', side_effect=apicalls.requests.ConnectionError)
+    def test_timeout_1(self, get):
+        # test that an API which can't be connected to serves the cached data
+        quota = apicalls.QuotaManager('Test', 48, 0)
+        quota.store({'articles': []})
+        self.assertEqual(apicalls.budgeted_get(quota, 'http://test', apicalls.REFRESH),
+                         {'articles': []})
+
+    # Test Bulk Import and Export
+    def test_bulk(self):
+        # test that alarms are the same after being written and read in both formats
+        alarms = [('Wake up', ['2030-01-01', '07:30'], 1, 0),
+                  ('Meeting: \u00e9quipe', ['2030-01-02', '12:59'], 0, 1)]
+        for writer in [bulk.write_ndjson, bulk.write_binary]:
+            stream = io.BytesIO(b''.join(writer(alarms)))
+            result = [record[:4] for chunk in bulk.read_alarms(stream) for record in chunk]
+            self.assertEqual(result, alarms)
+
+        # test that dates, times and flags are stored in the same format as the form uses
+        stream = io.BytesIO(b'{"alarm": "2030-1-1T7:30", "message": "Gym", "news": 1}\n')
+        result = [record[:4] for chunk in bulk.read_alarms(stream) for record in chunk]
+        self.assertEqual(result, [('Gym', ['2030-01-01', '07:30'], 1, 0)])
+        for flag in [b'true', b'1.0']:
+            stream = io.BytesIO(b'{"alarm": "2030-01-01T07:30", "message": "Gym", "news": '
+                                + flag + b'}\n')
+            with self.assertRaisesRegex(ValueError, 'Alarm 1'):
+                list(bulk.read_alarms(stream))
+
+        # test that a block claiming more than CHUNK_SIZE alarms is rejected before it is read
+        stream = io.BytesIO(bulk.MAGIC + bulk.BLOCK_HEADER.pack(bulk.CHUNK_SIZE + 1, 0))
+        with self.assertRaisesRegex(ValueError, 'too large'):
+            list(bulk.read_alarms(stream))
+
+        # test that a time which is out of range in the binary format says which alarm it was
+        stream = io.BytesIO(bulk.MAGIC + bulk.pack_block([0xFFFFFFFF], [0], [b'Gym']))
+        with self.assertRaisesRegex(ValueError, 'Alarm 1'):
+            list(bulk.read_alarms(stream))
+
+        # test that an invalid alarm says which line it was on
+        stream = io.BytesIO(b'{"alarm": "2030-01-01T07:30", "message": "ok"}\n'
+                            b'{"alarm": "2030-13-01T07:30", "message": "bad"}\n')
+        with self.assertRaisesRegex(ValueError, 'Alarm 2'):
+            list(bulk.read_alarms(stream))
+
+    @mock.patch('app.threading.Thread')
+    def test_bulk_1(self, thread):
+        # test that many alarms are scheduled in one batch with a single thread, and that alarms
+        # in the past are skipped
+        alarms = [('Alarm ' + str(i), ['2030-01-01', '07:30'], i % 2, 0) for i in range(2000)]
+        alarms.append(('Too late', ['2020-01-01', '07:30'], 0, 0))
+        stream = io.BytesIO(b''.join(bulk.write_binary(alarms)))
+        self.addCleanup(self.cancel_alarms)
+        start = time.time()
+        result = app.import_alarms(stream)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(result, {'imported': 2000, 'skipped': 1})
+        self.assertEqual(thread.call_count, 1)
+        self.assertEqual(app.alarm_list[-1].get_data()['priority'], 2000)
+
+        # test that imported alarms don't reuse the id of an alarm that has been deleted
+        app.delete_alarm(app.alarm_list[0].id, False, True)
+        stream = io.BytesIO(b''.join(bulk.write_binary(alarms[:1])))
+        app.import_alarms(stream)
+        self.assertEqual(len(app.sched_dict), len(app.alarm_list))
+
+    @mock.patch('app.threading.Thread')
+    def test_bulk_2(self, thread):
+        # test that deleting an alarm without news doesn't give back the news request kept for
+        # another alarm due at the same time
+        alarms = [('News', ['2030-01-01', '07:30'], 1, 0),
+                  ('No News', ['2030-01-01', '07:30'], 0, 0)]
+        self.addCleanup(self.cancel_alarms)
+        app.import_alarms(io.BytesIO(b''.join(bulk.write_ndjson(alarms))))
+        app.delete_alarm(app.alarm_list[1].id, False, True)
+        self.assertEqual(len(apicalls.news_quota.reservations), 1)
+
+    @mock.patch('app.threading.Thread')
+    @mock.patch('bulk.CHUNK_SIZE', 2)
+    def test_bulk_3(self, thread):
+        # test that an invalid alarm in a later chunk undoes the alarms set from earlier chunks
+        stream = io.BytesIO(b'{"alarm": "2030-01-01T07:30", "message": "a", "news": 1}\n'
+                            b'{"alarm": "2030-01-01T07:31", "message": "b", "weather": 1}\n'
+                            b'{"alarm": "2030-01-01T07:32", "message": ""}\n')
+        with self.assertRaisesRegex(ValueError, 'Alarm 3'):
+            app.import_alarms(stream)
+        self.assertEqual(app.alarm_list, [])
+        self.assertEqual(app.alarm_dict, {})
+        self.assertEqual(app.sched_dict, {})
+        self.assertTrue(app.s.empty())
+        self.assertEqual(apicalls.news_quota.reservations, [])
+        self.assertEqual(apicalls.weather_quota.reservations, [])
+        self.assertEqual(thread.call_count, 0)
+
+    def test_quota_4(self):
+        # test that the spend of a key is kept when the program is restarted
+        with tempfile.TemporaryDirectory() as folder:
+            state_file = os.path.join(folder, 'quota.json')
+            quota = apicalls.QuotaManager('Test', 48, 300, state_file)
+            quota.acquire(apicalls.REFRESH)
+            quota.acquire(apicalls.REFRESH)
+            quota = apicalls.QuotaManager('Test', 48, 300, state_file)
+            self.assertEqual(quota.get_report()['spent'], 2)
+            self.assertFalse(quota.acquire(apicalls.REFRESH))
+
+    def cancel_alarms(self):
+        # cancel the alarms set by a test so they don't ring, and give back their reservations
+        app.cancel_alarms(list(app.alarm_list))
+
 
 # the code below allows us to run the test.py file and unittest to work, as
 # opposed to having to enter "python -m unittest test.py" in the terminal